@@ -1,15 +1,51 @@
+import asyncio
 import os
-import shutil
 import subprocess
+import tarfile
 import tempfile
+import zipfile
 from pathlib import Path
+from typing import Any
+
+from pywintypes import com_error
+from win32com.client import Dispatch
+
+from wimpatcher.modules.utils import (
+    LoadedHive,
+    copy_files,
+    move_file,
+    run_with_progress,
+)
+
+# Magic numbers of the archive formats we know how to extract
+ZIP_SIGNATURE = b"PK\x03\x04"
+GZIP_SIGNATURE = b"\x1f\x8b"
+SEVEN_ZIP_SIGNATURE = b"7z\xbc\xaf\x27\x1c"
+RAR_SIGNATURE = b"Rar!\x1a\x07"
+CAB_SIGNATURE = b"MSCF"
+
+# Fallback used to create shortcuts when the WScript.Shell COM object is unavailable
+_VBS_TEMPLATE = """
+Set WshShell = WScript.CreateObject("WScript.Shell")
+Set Shortcut = WshShell.CreateShortcut("{dest}")
+
+Shortcut.TargetPath = "{target}"
+Shortcut.WorkingDirectory = "{workdir}"
+Shortcut.WindowStyle = 1
+Shortcut.IconLocation = "{target}, 0"
+
+Shortcut.Save
+"""
 
-import patoolib
 
-from wimpatcher.modules.utils import add_key_to_run_once_hive
+def _escape_vbs(value: str) -> str:
+    """Escapes a value to be used inside of a VBScript string literal."""
+    return value.replace('"', '""')
 
 
 class Installer:
+    _shell: Any = None
+
     def __init__(
         self: "Installer",
         program_name: str,
@@ -33,10 +69,13 @@ class Installer:
         self.wim_mount_directory: str = os.path.abspath(wim_mount_directory)
         self.parameters: list[str] = parameters or []
 
-        if self.wim_mount_directory not in self.install_location:
+        self._install: Path = Path(install_location).resolve()
+        self._mount: Path = Path(wim_mount_directory).resolve()
+        if not self._install.is_relative_to(self._mount):
             raise ValueError(
                 f"install_location must be in wim_mount_directory! Values provided: {self.install_location} and {self.wim_mount_directory}"
             )
+        self._rel_install: Path = self._install.relative_to(self._mount)
 
     def install(self: "Installer"):
         """Install the program at the specified location."""
@@ -48,57 +87,123 @@ class Installer:
             raise ValueError(f"'{self.installer_file}' is not a file or a folder!")
 
     def _install_from_dir(self: "Installer"):
-        if os.path.exists(self.install_location):
-            shutil.rmtree(self.install_location)
-        shutil.copytree(self.installer_file, self.install_location)
+        os.makedirs(self.install_location, exist_ok=True)
+        # /MIR removes the files of a previous install that are not in the installer
+        copy_files(self.installer_file, self.install_location, ["/MIR"])
 
     def _install_from_file(self: "Installer"):
-        if not os.path.exists(self.install_location):
-            os.makedirs(self.install_location)
+        os.makedirs(self.install_location, exist_ok=True)
+
+        # If the file is an archive (ZIP, RAR, etc), extract it at the install location
+        if self._install_from_archive(self._sniff()):
+            return
+        # Assume the installer file is an executable, which we will run inside the OS on first logon
+        self._install_from_executable()
+
+    def _sniff(self: "Installer") -> bytes:
+        with open(self.installer_file, "rb") as f:
+            return f.read(16)
+
+    def _install_from_archive(self: "Installer", header: bytes) -> bool:
+        if header.startswith(ZIP_SIGNATURE):
+            return self._extract_zip()
+        if header.startswith(GZIP_SIGNATURE):
+            return self._extract_tar()
+        if header.startswith((SEVEN_ZIP_SIGNATURE, RAR_SIGNATURE)):
+            return self._extract_7z()
+        if header.startswith(CAB_SIGNATURE):
+            return self._extract_cab()
+        return False
+
+    def _extract_zip(self: "Installer") -> bool:
+        try:
+            with zipfile.ZipFile(self.installer_file) as archive:
+                archive.extractall(self.install_location)
+        except zipfile.BadZipFile:
+            return False
+        return True
 
-        if os.path.isfile(self.installer_file):
-            try:
-                # If the file is an archive (ZIP, RAR, etc), extract it at the install location
-                self._install_from_archive()
-            except patoolib.util.PatoolError:
-                # Assume the installer file is an executable, which we will run inside the OS on first logon
-                self._install_from_executable()
+    def _extract_tar(self: "Installer") -> bool:
+        try:
+            with tarfile.open(self.installer_file, "r:gz") as archive:
+                archive.extractall(self.install_location, filter="data")
+        except tarfile.ReadError:
+            # Gzipped file which is not a tarball
+            return False
+        return True
+
+    def _extract_7z(self: "Installer") -> bool:
+        # -bso1 -bsp1 stream the output and progress of 7z to stdout as it extracts
+        return_code = asyncio.run(
+            run_with_progress(
+                [
+                    "7z",
+                    "x",
+                    self.installer_file,
+                    f"-o{self.install_location}",
+                    "-y",
+                    "-bso1",
+                    "-bsp1",
+                ]
+            )
+        )
+        return return_code == 0
 
-    def _install_from_archive(self: "Installer"):
-        patoolib.extract_archive(self.installer_file, outdir=self.install_location)
+    def _extract_cab(self: "Installer") -> bool:
+        result = subprocess.run(
+            ["expand.exe", self.installer_file, "-F:*", self.install_location],
+            stdout=subprocess.PIPE,
+        )
+        return result.returncode == 0
 
     def _install_from_executable(self: "Installer"):
-        shutil.move(self.installer_file, self.install_location)
-        add_key_to_run_once_hive(
-            rf"{self.wim_mount_directory}\Windows\System32\config\SOFTWARE",
-            f"install {self.program_name}",
-            rf"C:\{self.install_location.removeprefix(self.wim_mount_directory)}",
+        move_file(
+            self.installer_file,
+            os.path.join(self.install_location, os.path.basename(self.installer_file)),
         )
+        with LoadedHive(
+            rf"{self.wim_mount_directory}\Windows\System32\config\SOFTWARE"
+        ) as hive:
+            hive.add_run_once(
+                f"install {self.program_name}", rf"C:\{self._rel_install}"
+            )
 
-    @staticmethod
-    def create_shortcut(src: str, dest: str):
+    @classmethod
+    def create_shortcut(cls: type["Installer"], src: str, dest: str):
         """Create a shortcut to a program.
 
         Args:
             src (str): The path to the program executable.
             dest (str): The path where the shortcut should be created.
         """
-        vbs_script = f"""
-Set WshShell = WScript.CreateObject("WScript.Shell")
-Set Shortcut = WshShell.CreateShortcut("{dest}")
-
-Shortcut.TargetPath = "{src}"
-Shortcut.WorkingDirectory = "{Path(src).parent}"
-Shortcut.WindowStyle = 1
-Shortcut.IconLocation = "{src}, 0"
+        # The WScript.Shell COM object is shared by every shortcut we create
+        if cls._shell is None:
+            try:
+                cls._shell = Dispatch("WScript.Shell")
+            except com_error:
+                cls._create_shortcut_vbs(src, dest)
+                return
+
+        shortcut = cls._shell.CreateShortcut(dest)
+        shortcut.TargetPath = src
+        shortcut.WorkingDirectory = str(Path(src).parent)
+        shortcut.WindowStyle = 1
+        shortcut.IconLocation = f"{src}, 0"
+        shortcut.Save()
 
-Shortcut.Save
-        """
+    @staticmethod
+    def _create_shortcut_vbs(src: str, dest: str):
+        vbs_script = _VBS_TEMPLATE.format_map(
+            {
+                "target": _escape_vbs(src),
+                "dest": _escape_vbs(dest),
+                "workdir": _escape_vbs(str(Path(src).parent)),
+            }
+        )
         with tempfile.NamedTemporaryFile(
             mode="w", suffix=".vbs", delete=False
         ) as vbs_file:
             vbs_file.write(vbs_script)
-            vbs_file.flush()
 
         try:
             subprocess.run(
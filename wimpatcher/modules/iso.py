@@ -1,56 +1,191 @@
+import ctypes
 import os
-import subprocess
+import string
+import time
+from ctypes import wintypes
 
-from modules.utils import copy_files
+from modules.utils import copy_file_preallocated, copy_files
 from pycdlib import pycdlib
 
 
-def add_files_to_iso(iso: pycdlib.PyCdlib, source_path: str, iso_path: str) -> None:
+class GUID(ctypes.Structure):
+    _fields_ = [
+        ("Data1", wintypes.DWORD),
+        ("Data2", wintypes.WORD),
+        ("Data3", wintypes.WORD),
+        ("Data4", ctypes.c_ubyte * 8),
+    ]
+
+
+class VIRTUAL_STORAGE_TYPE(ctypes.Structure):
+    _fields_ = [("DeviceId", wintypes.ULONG), ("VendorId", GUID)]
+
+
+class ATTACH_VIRTUAL_DISK_PARAMETERS(ctypes.Structure):
+    _fields_ = [("Version", wintypes.DWORD), ("Reserved", wintypes.ULONG)]
+
+
+VIRTUAL_STORAGE_TYPE_DEVICE_ISO = 1
+VIRTUAL_STORAGE_TYPE_VENDOR_MICROSOFT = GUID(
+    0xEC984AEC,
+    0xA0F9,
+    0x47E9,
+    (ctypes.c_ubyte * 8)(0x90, 0x1F, 0x71, 0x41, 0x5A, 0x66, 0x34, 0x5B),
+)
+VIRTUAL_DISK_ACCESS_READ = 0x000D0000
+ATTACH_VIRTUAL_DISK_VERSION_1 = 1
+ATTACH_VIRTUAL_DISK_FLAG_READ_ONLY = 0x00000001
+# Keeps the ISO attached once its handle is closed, until DetachVirtualDisk is called
+ATTACH_VIRTUAL_DISK_FLAG_PERMANENT_LIFETIME = 0x00000004
+
+# Calling the Virtual Disk API directly saves us a powershell launch for each (un)mount
+virtdisk = ctypes.WinDLL("virtdisk.dll")
+kernel32 = ctypes.WinDLL("kernel32.dll", use_last_error=True)
+
+virtdisk.OpenVirtualDisk.restype = wintypes.DWORD
+virtdisk.OpenVirtualDisk.argtypes = [
+    ctypes.POINTER(VIRTUAL_STORAGE_TYPE),
+    wintypes.LPCWSTR,
+    wintypes.DWORD,
+    wintypes.DWORD,
+    ctypes.c_void_p,
+    ctypes.POINTER(wintypes.HANDLE),
+]
+virtdisk.AttachVirtualDisk.restype = wintypes.DWORD
+virtdisk.AttachVirtualDisk.argtypes = [
+    wintypes.HANDLE,
+    ctypes.c_void_p,
+    wintypes.DWORD,
+    wintypes.ULONG,
+    ctypes.POINTER(ATTACH_VIRTUAL_DISK_PARAMETERS),
+    ctypes.c_void_p,
+]
+virtdisk.DetachVirtualDisk.restype = wintypes.DWORD
+virtdisk.DetachVirtualDisk.argtypes = [wintypes.HANDLE, wintypes.DWORD, wintypes.ULONG]
+virtdisk.GetVirtualDiskPhysicalPath.restype = wintypes.DWORD
+virtdisk.GetVirtualDiskPhysicalPath.argtypes = [
+    wintypes.HANDLE,
+    ctypes.POINTER(wintypes.ULONG),
+    wintypes.LPWSTR,
+]
+kernel32.QueryDosDeviceW.restype = wintypes.DWORD
+kernel32.QueryDosDeviceW.argtypes = [wintypes.LPCWSTR, wintypes.LPWSTR, wintypes.DWORD]
+kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+
+
+def clone_iso_substituting(
+    src_iso: str, dst_iso: str, substitutions: dict[str, str]
+) -> None:
     """
-    Adds files and directories from a source directory to an ISO file.
+    Creates a copy of an ISO file in which some files are replaced.
+
+    Unchanged files are streamed straight from the source ISO file into the new one,
+    and its boot records are kept as they are.
 
     Args:
-        iso (pycdlib.PyCdlib): The ISO file to add the files and directories to.
-        source_path (str): The path to the source directory.
-        iso_path (str): The path to the ISO directory.
+        src_iso (str): The path to the source ISO file.
+        dst_iso (str): The path to the ISO file to be created.
+        substitutions (dict[str, str]): Maps the UDF path of files in the ISO, such as "/sources/install.wim",
+            to the path of the file replacing them.
 
     Returns:
         None
+
+    Raises:
+        ValueError: If the source and destination ISO files are the same file.
     """
-    for root, dirs, files in os.walk(source_path):
-        for d in dirs:
-            abs_dir = os.path.join(root, d)
-            rel_dir = os.path.relpath(abs_dir, source_path)
-            iso_dir = os.path.join(iso_path, rel_dir).replace("\\", "/")
-            iso.add_directory(udf_path=iso_dir)
+    # The source ISO is read while the new one is written, writing over it would destroy it
+    if os.path.abspath(src_iso) == os.path.abspath(dst_iso) or (
+        os.path.exists(dst_iso) and os.path.samefile(src_iso, dst_iso)
+    ):
+        raise ValueError(f'Cannot write the new iso over its source "{src_iso}"')
 
-        for file in files:
-            abs_path = os.path.join(root, file)
-            rel_path = os.path.relpath(abs_path, source_path)
-            iso_path_file = os.path.join(iso_path, rel_path).replace("\\", "/")
+    iso = pycdlib.PyCdlib()
+    iso.open(src_iso)
+    try:
+        for udf_path, new_file in substitutions.items():
+            iso.rm_file(udf_path=udf_path)
+            iso.add_file(new_file, udf_path=udf_path)
 
-            print(abs_path, iso_path_file)
-            iso.add_file(abs_path, udf_path=iso_path_file)
+        # An 8 MB buffer turns pycdlib's many small writes into few large ones
+        with open(dst_iso, "wb", buffering=8 * 1024 * 1024) as iso_fp:
+            iso.write_fp(iso_fp)
+    finally:
+        iso.close()
 
 
-def create_iso_from_folder(folder_path: str, iso_path: str) -> None:
+def open_iso(iso_file: str) -> wintypes.HANDLE:
     """
-    Creates an ISO file from a source directory.
+    Opens an ISO file as a virtual disk.
 
     Args:
-        folder_path (str): The path to the source directory.
-        iso_path (str): The path to the ISO file to be created.
+        iso_file (str): The path to the ISO file.
 
     Returns:
-        None
+        A handle to the virtual disk, which must be closed with `CloseHandle`.
+
+    Raises:
+        OSError: If the ISO file could not be opened.
     """
-    iso = pycdlib.PyCdlib()
-    iso.new(udf="2.60", interchange_level=4, vol_ident="UDF Volume")
+    storage_type = VIRTUAL_STORAGE_TYPE(
+        VIRTUAL_STORAGE_TYPE_DEVICE_ISO, VIRTUAL_STORAGE_TYPE_VENDOR_MICROSOFT
+    )
+    handle = wintypes.HANDLE()
+    result = virtdisk.OpenVirtualDisk(
+        ctypes.byref(storage_type),
+        os.path.abspath(iso_file),
+        VIRTUAL_DISK_ACCESS_READ,
+        0,
+        None,
+        ctypes.byref(handle),
+    )
+    if result != 0:
+        raise ctypes.WinError(result, f'Could not open the iso file "{iso_file}"')
+    return handle
+
+
+def query_dos_device(device_name: str) -> str:
+    """
+    Returns the NT device path a DOS device name (such as "E:" or "CDROM1") points to.
+
+    Args:
+        device_name (str): The DOS device name.
+
+    Returns:
+        The NT device path, or an empty string if the device does not exist.
+    """
+    buffer = ctypes.create_unicode_buffer(1024)
+    if not kernel32.QueryDosDeviceW(device_name, buffer, len(buffer)):
+        return ""
+    return buffer.value
 
-    add_files_to_iso(iso, folder_path, "/")
 
-    iso.write(iso_path)
-    iso.close()
+def find_drive_letter(physical_path: str, timeout: float = 10) -> str:
+    """
+    Finds the drive letter assigned to the volume of a physical disk.
+
+    Args:
+        physical_path (str): The physical path of the disk, such as "\\\\.\\CDROM1".
+        timeout (float, optional): Seconds to wait for a drive letter to be assigned. Defaults to 10.
+
+    Returns:
+        The drive letter of the disk.
+
+    Raises:
+        TimeoutError: If no drive letter was assigned to the disk in time.
+    """
+    device = query_dos_device(physical_path.removeprefix("\\\\.\\")).lower()
+    deadline = time.monotonic() + timeout
+
+    # The mount manager assigns the drive letter asynchronously after the disk is attached
+    while time.monotonic() < deadline:
+        drives = kernel32.GetLogicalDrives()
+        for i, letter in enumerate(string.ascii_uppercase):
+            if drives & (1 << i) and query_dos_device(f"{letter}:").lower() == device:
+                return letter
+        time.sleep(0.1)
+
+    raise TimeoutError(f"No drive letter was assigned to {physical_path}")
 
 
 def mount_iso(iso_file: str) -> str:
@@ -62,21 +197,44 @@ def mount_iso(iso_file: str) -> str:
 
     Returns:
         The drive letter of the mounted drive.
+
+    Raises:
+        OSError: If the ISO file could not be mounted.
     """
-    mount_result = subprocess.run(
-        [
-            "powershell",
-            "(Mount-DiskImage",
-            "-ImagePath",
-            iso_file,
-            "-PassThru",
-            "|",
-            "Get-Volume).DriveLetter",
-        ],
-        capture_output=True,
-        text=True,
-    )
-    return f"{mount_result.stdout.strip()}:"
+    handle = open_iso(iso_file)
+    try:
+        parameters = ATTACH_VIRTUAL_DISK_PARAMETERS(ATTACH_VIRTUAL_DISK_VERSION_1, 0)
+        result = virtdisk.AttachVirtualDisk(
+            handle,
+            None,
+            ATTACH_VIRTUAL_DISK_FLAG_READ_ONLY
+            | ATTACH_VIRTUAL_DISK_FLAG_PERMANENT_LIFETIME,
+            0,
+            ctypes.byref(parameters),
+            None,
+        )
+        if result != 0:
+            raise ctypes.WinError(result, f'Could not mount the iso file "{iso_file}"')
+
+        # The disk outlives this process, so it must be detached if it cannot be used
+        try:
+            path_size = wintypes.ULONG(1024)
+            physical_path = ctypes.create_unicode_buffer(path_size.value // 2)
+            result = virtdisk.GetVirtualDiskPhysicalPath(
+                handle, ctypes.byref(path_size), physical_path
+            )
+            if result != 0:
+                raise ctypes.WinError(
+                    result, f'Could not locate the iso file "{iso_file}"'
+                )
+            drive_letter = find_drive_letter(physical_path.value)
+        except BaseException:
+            virtdisk.DetachVirtualDisk(handle, 0, 0)
+            raise
+    finally:
+        kernel32.CloseHandle(handle)
+
+    return f"{drive_letter}:"
     # TODO: add support for `with` statement
 
 
@@ -89,11 +247,42 @@ def unmount_iso(iso_file: str) -> None:
 
     Returns:
         None
+
+    Raises:
+        OSError: If the ISO file could not be unmounted.
     """
-    subprocess.run(
-        ["powershell", "Dismount-DiskImage", "-ImagePath", iso_file],
-        stdout=subprocess.PIPE,
-    )
+    handle = open_iso(iso_file)
+    try:
+        result = virtdisk.DetachVirtualDisk(handle, 0, 0)
+        if result != 0:
+            raise ctypes.WinError(
+                result, f'Could not unmount the iso file "{iso_file}"'
+            )
+    finally:
+        kernel32.CloseHandle(handle)
+
+
+def extract_file_from_iso(iso_file: str, file_path: str, dest: str) -> None:
+    """
+    Extracts a single file of an ISO file to a specified location.
+
+    Args:
+        iso_file (str): The path to the ISO file.
+        file_path (str): The path of the file inside of the ISO file, such as "sources\\install.wim".
+        dest (str): The path the file should be extracted to.
+
+    Returns:
+        None
+    """
+    print(f'Mounting iso "{iso_file}"...', flush=True)
+    iso_mount_path: str = mount_iso(iso_file)
+
+    try:
+        print(f"Extracting {file_path}...", flush=True)
+        copy_file_preallocated(f"{iso_mount_path}\\{file_path}", dest)
+    finally:
+        print(f'Unmounting iso "{iso_file}"...')
+        unmount_iso(iso_file)
 
 
 def extract_iso(iso_file: str, extract_location: str) -> None:
@@ -107,12 +296,20 @@ def extract_iso(iso_file: str, extract_location: str) -> None:
     Returns:
         None
     """
-    print(f'Mounting iso "{iso_file}"...')
+    print(f'Mounting iso "{iso_file}"...', flush=True)
     iso_mount_path: str = mount_iso(iso_file)
 
     try:
-        print("Extracting iso file...")
-        copy_files(iso_mount_path, extract_location)
+        print("Extracting iso file...", flush=True)
+        # install.wim is by far the largest file of the iso, preallocating it keeps it from being fragmented
+        iso_wim_file = f"{iso_mount_path}\\sources\\install.wim"
+        if os.path.isfile(iso_wim_file):
+            os.makedirs(f"{extract_location}\\sources", exist_ok=True)
+            copy_file_preallocated(
+                iso_wim_file, f"{extract_location}\\sources\\install.wim"
+            )
+
+        copy_files(iso_mount_path, extract_location, ["/XF", iso_wim_file])
     finally:
         print(f'Unmounting iso "{iso_file}"...')
         unmount_iso(iso_file)
@@ -0,0 +1,109 @@
+from typing import Any
+
+import win32com.client
+
+STORAGE_NAMESPACE = "winmgmts:root\\Microsoft\\Windows\\Storage"
+PARTITION_STYLE_MBR = 1
+
+# Creating the COM connection is the most expensive part of a WMI call, so it is shared by every call
+_connection = None
+
+
+def get_connection() -> Any:
+    """
+    Returns the connection to the Windows Storage Management WMI namespace,
+    creating it on first use.
+
+    Returns:
+        The SWbemServices object of the namespace.
+    """
+    global _connection
+    if _connection is None:
+        _connection = win32com.client.GetObject(STORAGE_NAMESPACE)
+    return _connection
+
+
+def call_method(instance: Any, method: str, **parameters: Any) -> Any:
+    """
+    Calls a method of a WMI object with the given parameters.
+
+    Args:
+        instance (Any): The WMI object.
+        method (str): The name of the method to call.
+        **parameters (Any): The parameters of the method.
+
+    Returns:
+        The output parameters of the method.
+
+    Raises:
+        OSError: If the method did not succeed.
+    """
+    in_parameters = instance.Methods_(method).InParameters.SpawnInstance_()
+    for name, value in parameters.items():
+        in_parameters.Properties_.Item(name).Value = value
+
+    result = instance.ExecMethod_(method, in_parameters)
+    if result.ReturnValue != 0:
+        e = OSError(f"{instance.Path_.Class}.{method} failed")
+        e.errno = result.ReturnValue
+        raise e
+    return result
+
+
+def query_one(query: str) -> Any:
+    """
+    Runs a WQL query and returns its first result.
+
+    Args:
+        query (str): The WQL query.
+
+    Returns:
+        The first WMI object matching the query.
+
+    Raises:
+        LookupError: If nothing matches the query.
+    """
+    for instance in get_connection().ExecQuery(query):
+        return instance
+    raise LookupError(f"No result for '{query}'")
+
+
+def format_drive(drive_letter: str) -> None:
+    """
+    Wipes the disk holding a drive, and formats it as a single active NTFS partition.
+
+    Args:
+        drive_letter (str): The drive letter assigned to a partition of the disk.
+
+    Raises:
+        LookupError: If no partition is assigned to the drive letter.
+        OSError: If a step of the formatting failed.
+    """
+    partition = query_one(
+        f"SELECT DiskNumber FROM MSFT_Partition WHERE DriveLetter = '{drive_letter}'"
+    )
+    disk = query_one(f"SELECT * FROM MSFT_Disk WHERE Number = {partition.DiskNumber}")
+
+    call_method(disk, "Clear", RemoveData=True, RemoveOEM=True)
+    call_method(disk, "Initialize", PartitionStyle=PARTITION_STYLE_MBR)
+    result = call_method(
+        disk,
+        "CreatePartition",
+        UseMaximumSize=True,
+        IsActive=True,
+        DriveLetter=ord(drive_letter),
+    )
+
+    # The drive letter is assigned to the new volume asynchronously,
+    # so the volume is found through the partition it was created on
+    created_partition = result.CreatedPartition
+    partition = query_one(
+        "SELECT * FROM MSFT_Partition"
+        f" WHERE DiskNumber = {created_partition.DiskNumber}"
+        f" AND PartitionNumber = {created_partition.PartitionNumber}"
+    )
+    volume = query_one(
+        f"ASSOCIATORS OF {{{partition.Path_.RelPath}}}"
+        " WHERE AssocClass = MSFT_PartitionToVolume"
+    )
+    call_method(volume, "Format", FileSystem="NTFS", Full=False)
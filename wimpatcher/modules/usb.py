@@ -1,34 +1,24 @@
 import pathlib
 
 from modules.iso import extract_iso
-from modules.utils import copy_files, run_diskpart
+from modules.storage_wmi import format_drive
 
 
 def format_usb_drive(drive_letter: str) -> None:
     """
-    Formats a USB drive using the diskpart command line tool.
+    Formats a USB drive through the Windows Storage Management WMI provider.
 
     Args:
         drive_letter (str): The drive letter assigned to the USB drive.
 
     Returns:
-        Any: The output of the diskpart command.
+        None
 
+    Raises:
+        OSError: If the USB drive could not be formatted.
     """
-    commands: list[str] = [
-        "list disk",
-        f"select volume {drive_letter}",
-        f"remove letter={drive_letter}",
-        "clean",
-        "create partition primary",
-        "select partition 1",
-        "active",
-        "format fs=ntfs quick",
-        f"assign letter={drive_letter}",
-        "exit",
-    ]
-
-    run_diskpart(commands)
+    # Talking to WMI directly avoids starting a PowerShell process
+    format_drive(drive_letter)
 
 
 def prepare_usb_drive(iso_file: str, drive_path: str) -> None:
@@ -49,8 +39,8 @@ def prepare_usb_drive(iso_file: str, drive_path: str) -> None:
     if drive_path == home_drive:
         raise ValueError(f"USB Drive cannot be '{home_drive}'")
 
-    print("Cleaning and formatting the USB drive...")
-    format_usb_drive(drive_path[1])
+    print("Cleaning and formatting the USB drive...", flush=True)
+    format_usb_drive(drive_path[0])
 
     print("Copying files to the USB drive...")
     extract_iso(iso_file, drive_path)
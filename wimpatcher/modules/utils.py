@@ -1,31 +1,129 @@
+import asyncio
+import codecs
 import ctypes
+import errno
+import locale
+import msvcrt
 import os
-import stat
+import re
+import shutil
 import subprocess
 import sys
-import threading
 import winreg
+from ctypes import wintypes
 from enum import StrEnum
-from typing import Any, TextIO
+from typing import Any
 
 import tomllib
 import win32api
 import win32security
 
 
-def onerror(func, path, exc_info):
+FILE_ATTRIBUTE_NORMAL = 0x80
+COPY_FILE_NO_BUFFERING = 0x00001000
+FILE_BEGIN = 0
+SE_RESTORE_PRIVILEGE = win32security.LookupPrivilegeValue(None, "SeRestorePrivilege")  # type: ignore
+
+
+def clear_readonly(path: str) -> None:
+    """
+    Clears the attributes of a file, removing its read-only flag.
+
+    Args:
+        path (str): The path of the file.
+
+    Raises:
+        OSError: If the attributes of the file could not be changed.
+    """
+    if not ctypes.windll.kernel32.SetFileAttributesW(
+        ctypes.c_wchar_p(path), FILE_ATTRIBUTE_NORMAL
+    ):
+        raise ctypes.WinError()
+
+
+def move_file(src: str, dest: str) -> None:
+    """
+    Moves a file, renaming it when possible.
+
+    Across volumes, the file is copied with `CopyFileExW` without going through
+    the system cache, then the source file is deleted.
+
+    Args:
+        src (str): The path of the file to move.
+        dest (str): The path the file should be moved to.
+
+    Raises:
+        OSError: If the file could not be moved.
+    """
+    try:
+        os.replace(src, dest)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    # Unbuffered copies do not pollute the cache with large installer files
+    if not ctypes.windll.kernel32.CopyFileExW(
+        ctypes.c_wchar_p(src),
+        ctypes.c_wchar_p(dest),
+        None,
+        None,
+        None,
+        COPY_FILE_NO_BUFFERING,
+    ):
+        raise ctypes.WinError()
+    os.remove(src)
+
+
+def copy_file_preallocated(
+    src: str, dest: str, chunk_size: int = 8 * 1024 * 1024
+) -> None:
     """
-    Error handler for `shutil.rmtree`.
+    Copies a file, setting the size of the destination file before writing to it.
 
-    If the error is due to an access error (read only file)
-    it attempts to add write permission and then retries.
+    Sizing the file up front lets NTFS allocate it in a single contiguous extent
+    instead of growing it, and fragmenting it, with every write.
 
-    If the error is for another reason it re-raises the error.
+    Args:
+        src (str): The path of the file to copy.
+        dest (str): The path the file should be copied to.
+        chunk_size (int, optional): Size of the blocks the file is copied by. Defaults to 8 MB.
 
-    Usage : `shutil.rmtree(path, onerror=onerror)`
+    Raises:
+        OSError: If the destination file could not be preallocated.
     """
-    os.chmod(path, stat.S_IWRITE)
-    func(path)
+    size = os.path.getsize(src)
+    with open(src, "rb") as src_file, open(dest, "wb") as dest_file:
+        handle = wintypes.HANDLE(msvcrt.get_osfhandle(dest_file.fileno()))
+        kernel32 = ctypes.windll.kernel32
+        if not kernel32.SetFilePointerEx(
+            handle, ctypes.c_longlong(size), None, FILE_BEGIN
+        ) or not kernel32.SetEndOfFile(handle):
+            raise ctypes.WinError()
+        dest_file.seek(0)
+
+        shutil.copyfileobj(src_file, dest_file, chunk_size)
+
+
+def force_rmtree(path: str) -> None:
+    """
+    Deletes a directory tree, including its read-only, hidden and system files.
+
+    The attributes of every file and directory are cleared in a single walk beforehand,
+    so `shutil.rmtree` never has to retry on access errors.
+
+    Args:
+        path (str): The path of the directory to delete.
+    """
+    set_attributes = ctypes.windll.kernel32.SetFileAttributesW
+    set_attributes(ctypes.c_wchar_p(path), FILE_ATTRIBUTE_NORMAL)
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            set_attributes(
+                ctypes.c_wchar_p(os.path.join(root, name)), FILE_ATTRIBUTE_NORMAL
+            )
+
+    shutil.rmtree(path)
 
 
 class Operations(StrEnum):
@@ -49,82 +147,109 @@ def run_as_admin() -> None:
         sys.exit()
 
 
-def run_diskpart(commands: list[str]) -> None:
+async def show_progress(stream: asyncio.StreamReader) -> None:
     """
-    Executes the specified list of DiskPart commands in a DiskPart session.
+    Reads and prints the last given information from a given subprocess stream,
+    overwriting the previous line.
 
     Args:
-        commands (List[str]): A list of DiskPart commands to execute.
-    """
-    diskpart_process = subprocess.Popen(
-        ["diskpart"],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        universal_newlines=True,
+        stream (asyncio.StreamReader): The stdout stream of a subprocess containing progress data.
+    """
+    decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))(
+        errors="replace"
     )
+    line_len = 0
+    pending = ""
+    while chunk := await stream.read(4096):
+        # Progress bars are redrawn in place with '\r', so lines may end with either '\r' or '\n'
+        *lines, pending = re.split(r"[\r\n]", pending + decoder.decode(chunk))
+        progress_info = next(
+            (line.strip() for line in reversed(lines) if line.strip()), None
+        )
+        if progress_info is None:
+            continue
+        print(
+            progress_info,
+            end=(" " * (line_len - len(progress_info))) + "\r",
+            flush=True,
+        )
+        line_len = len(progress_info) + 1
 
-    if not diskpart_process.stdin:
-        return
-
-    for command in commands:
-        diskpart_process.stdin.write(f"{command}\n")
-
-    diskpart_process.stdin.write("exit\n")
-    diskpart_process.communicate()
+    print(" " * line_len, end="\r", flush=True)
 
 
-def show_progress(pipe: TextIO):
+async def run_with_progress(args: list[str]) -> int:
     """
-    Reads and prints the last given information from a given subprocess.PIPE object,
-    overwriting the previous line.
+    Runs a command, showing its output as progress until it exits.
 
     Args:
-        pipe (subprocess.PIPE): A subprocess.PIPE object containing progress data.
+        args (list[str]): The command and its arguments.
+
+    Returns:
+        int: The return code of the command.
     """
-    line_len = 0
-    while True:
-        line: str = str(pipe.readline())
-        if not line:
-            break
-        line = line.replace("\n", "")
-        progress_info = line.strip()
-        print(progress_info, end=(" " * (line_len - len(progress_info))) + "\r")
-        line_len = len(progress_info) + 1
+    # Messages announcing the command must be shown before its progress
+    sys.stdout.flush()
+    proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE)
 
-    print(" " * line_len, end="\r")
+    # Wait for the subprocess and its output to finish
+    await asyncio.gather(show_progress(proc.stdout), proc.wait())  # type: ignore
+    return proc.returncode  # type: ignore
 
 
-def copy_files(src: str, dest: str) -> None:
+def robocopy_command(
+    src: str, dest: str, extra_args: None | list[str] = None, threads: int = 16
+) -> list[str]:
     """
-    Copies files from the source directory to the destination directory
-    using 'robocopy' with specified options.
+    Builds the 'robocopy' command copying the source directory to the destination directory.
 
     Args:
         src (str): The source directory path.
         dest (str): The destination directory path.
+        extra_args (None | list[str], optional): Additional robocopy options. Defaults to None.
+        threads (int, optional): Number of threads robocopy copies the files with. Defaults to 16.
+
+    Returns:
+        list[str]: The robocopy command and its arguments.
     """
-    proc = subprocess.Popen(
-        [
-            "robocopy",
-            src,
-            dest,
-            "/e",
-            "/NS",
-            "/NC",
-            "/NDL",
-            "/NJS",
-        ],
-        stdout=subprocess.PIPE,
-        universal_newlines=True,
-    )
+    return [
+        "robocopy",
+        src,
+        dest,
+        "/e",
+        "/NS",
+        "/NC",
+        "/NDL",
+        "/NJS",
+        "/NP",
+        f"/MT:{threads}",
+        "/R:1",
+        "/W:1",
+        *(extra_args or []),
+    ]
+
+
+def copy_files(
+    src: str, dest: str, extra_args: None | list[str] = None, threads: int = 16
+) -> None:
+    """
+    Copies files from the source directory to the destination directory
+    using 'robocopy' with specified options.
 
-    stdout_thread = threading.Thread(target=show_progress, args=(proc.stdout,))
-    stdout_thread.start()
+    Args:
+        src (str): The source directory path.
+        dest (str): The destination directory path.
+        extra_args (None | list[str], optional): Additional robocopy options. Defaults to None.
+        threads (int, optional): Number of threads robocopy copies the files with. Defaults to 16.
 
-    # Wait for the subprocess and stdout thread to finish
-    proc.wait()
-    stdout_thread.join()
+    Raises:
+        subprocess.CalledProcessError: If robocopy failed to copy some of the files.
+    """
+    args = robocopy_command(src, dest, extra_args, threads)
+    returncode = asyncio.run(run_with_progress(args))
+    # Robocopy return codes below 8 all mean that the copy succeeded
+    if returncode >= 8:
+        raise subprocess.CalledProcessError(returncode, args)
 
 
 def load_registry_hive(hive_path: str, subkey: str) -> None:
@@ -139,9 +264,8 @@ def load_registry_hive(hive_path: str, subkey: str) -> None:
     # I do not know how this works exactly, but this piece of code gives us the "SeRestorePrivilege" privilege which is required to load hives into the registry
     priv_flags = win32security.TOKEN_ADJUST_PRIVILEGES | win32security.TOKEN_QUERY
     hToken = win32security.OpenProcessToken(win32api.GetCurrentProcess(), priv_flags)
-    privilege_id = win32security.LookupPrivilegeValue(None, "SeRestorePrivilege")  # type: ignore
     win32security.AdjustTokenPrivileges(
-        hToken, 0, [(privilege_id, win32security.SE_PRIVILEGE_ENABLED)]  # type: ignore
+        hToken, 0, [(SE_RESTORE_PRIVILEGE, win32security.SE_PRIVILEGE_ENABLED)]  # type: ignore
     )
 
     # Load the given hive
@@ -183,51 +307,59 @@ def unload_registry_hive(subkey: str) -> None:
         raise e
 
 
-def add_string_to_registry(
-    key: "winreg._KeyType", sub_key: str, key_name: str, value: str
-) -> None:
-    """
-    Adds a string value to the specified registry key and subkey.
-
-    Args:
-        key (winreg._KeyType): The registry key to add the value to.
-        sub_key (str): The registry subkey to add the value to.
-        key_name (str): The name of the registry value to be added.
-        value (str): The string value to be set for the registry value.
-    """
-    # Add the key and value to RunOnce
-    new_key = winreg.OpenKey(
-        key,
-        sub_key,
-        0,
-        winreg.KEY_SET_VALUE,
-    )
-    winreg.SetValueEx(new_key, key_name, 0, winreg.REG_SZ, value)
-    winreg.CloseKey(new_key)
-
-
-def add_key_to_run_once_hive(hive_path: str, key_name: str, value: str) -> None:
+class LoadedHive:
     """
-    Adds a key to the RunOnce section of an offline SOFTWARE registry hive.
-
-    Args:
-        hive_path (str): The path of the offline SOFTWARE registry hive.
-        key_name (str): The name of the registry key to be added to RunOnce.
-        value (str): The command to be executed when the RunOnce key is triggered.
+    Context manager loading an offline SOFTWARE registry hive once,
+    so that several RunOnce keys can be added to it before it is unloaded.
+
+    Usage:
+    ```
+    with LoadedHive(hive_path) as hive:
+        hive.add_run_once("install A", "cmdA")
+        hive.add_run_once("install B", "cmdB")
+    ```
     """
-    subkey = "WIM_SOFTWARE"
-
-    load_registry_hive(hive_path, subkey)
 
-    try:
-        add_string_to_registry(
-            winreg.HKEY_LOCAL_MACHINE,
-            r"WIM_SOFTWARE\Microsoft\Windows\CurrentVersion\RunOnce",
-            key_name,
-            value,
-        )
-    finally:
-        unload_registry_hive(subkey)
+    def __init__(self: "LoadedHive", hive_path: str, subkey: str = "WIM_SOFTWARE"):
+        """
+        Args:
+            hive_path (str): The path of the offline SOFTWARE registry hive.
+            subkey (str, optional): The registry subkey under which to load the hive. Defaults to "WIM_SOFTWARE".
+        """
+        self.hive_path: str = hive_path
+        self.subkey: str = subkey
+        self._run_once: "winreg._KeyType | None" = None
+
+    def __enter__(self: "LoadedHive") -> "LoadedHive":
+        load_registry_hive(self.hive_path, self.subkey)
+
+        try:
+            self._run_once = winreg.OpenKey(
+                winreg.HKEY_LOCAL_MACHINE,
+                rf"{self.subkey}\Microsoft\Windows\CurrentVersion\RunOnce",
+                0,
+                winreg.KEY_SET_VALUE,
+            )
+        except OSError:
+            unload_registry_hive(self.subkey)
+            raise
+        return self
+
+    def __exit__(self: "LoadedHive", *exc_info) -> None:
+        try:
+            winreg.CloseKey(self._run_once)  # type: ignore
+        finally:
+            unload_registry_hive(self.subkey)
+
+    def add_run_once(self: "LoadedHive", key_name: str, value: str) -> None:
+        """
+        Adds a key to the RunOnce section of the hive.
+
+        Args:
+            key_name (str): The name of the registry key to be added to RunOnce.
+            value (str): The command to be executed when the RunOnce key is triggered.
+        """
+        winreg.SetValueEx(self._run_once, key_name, 0, winreg.REG_SZ, value)  # type: ignore
 
 
 def read_toml(path: str) -> dict[str, Any]:
@@ -1,18 +1,37 @@
+import asyncio
+import functools
+import hashlib
+import json
 import os
-import shutil
+import re
 import subprocess
 import tempfile
-import threading
+from typing import IO, Any, Iterator
 
-from modules.utils import onerror, show_progress
+from modules.utils import clear_readonly, force_rmtree, run_with_progress
 
+# Persists the indexes of the WIM files we listed across runs
+WIM_INDEX_CACHE = os.path.join(
+    os.environ.get("LOCALAPPDATA", tempfile.gettempdir()),
+    "WimPatcher",
+    "wim_index_cache.json",
+)
+WIM_INDEX_CACHE_SIZE = 32
+# Parts of a WIM file hashed to recognize it in the cache
+WIM_HEADER_SIZE = 4096
+WIM_TAIL_SIZE = 1024 * 1024
 
-def mount_wim(wim_file: str) -> str:
+# Matches a "Key : Value" line of `dism /get-WimInfo`
+_KV = re.compile(r"(\w[\w ]*?)\s*:\s*(.+)")
+
+
+def mount_wim(wim_file: str, index: str = "1") -> str:
     """
     Mounts a Windows Imaging Format (WIM) file to a temporary directory.
 
     Args:
         wim_file (str): The path to the WIM file to be mounted.
+        index (str, optional): The index of the image to mount. Defaults to "1".
 
     Returns:
         str: The path to the mount point.
@@ -22,102 +41,78 @@ def mount_wim(wim_file: str) -> str:
     if not os.path.exists(mount_path):
         os.mkdir(mount_path)
 
-    subprocess.run(["attrib", "-r", wim_file])
-
-    proc = subprocess.Popen(
-        [
-            "DISM",
-            "/Mount-WIM",
-            f"/WimFile:{wim_file}",
-            "/Index:1",
-            f"/MountDir:{mount_path}",
-        ],
-        stdout=subprocess.PIPE,
-        universal_newlines=True,
+    clear_readonly(wim_file)
+
+    asyncio.run(
+        run_with_progress(
+            [
+                "DISM",
+                "/Mount-WIM",
+                f"/WimFile:{wim_file}",
+                f"/Index:{index}",
+                f"/MountDir:{mount_path}",
+            ]
+        )
     )
 
-    stdout_thread = threading.Thread(target=show_progress, args=(proc.stdout,))
-    stdout_thread.start()
-
-    proc.wait()
-    stdout_thread.join()
-
     return mount_path
     # TODO: add support for `with` statement
 
 
-def unmount_wim(wim_mount_path: str) -> None:
+def open_wim_file(path: str, mode: str = "w", buffer_size: int = 1 << 20) -> IO:
     """
-    Unmounts a previously mounted Windows Imaging Format (WIM) file and commits changes.
+    Opens a file inside of a mounted Windows Imaging Format (WIM) image.
+
+    Every write to a mounted image is expensive, so the file is given a large
+    buffer which turns many small writes into a few large ones.
 
     Args:
-        wim_mount_path (str): The path to the mount point of the WIM file.
+        path (str): The path to the file, inside of the mount point.
+        mode (str, optional): The mode to open the file in. Defaults to "w".
+        buffer_size (int, optional): The size of the write buffer. Defaults to 1 MB.
 
     Returns:
-        None
-
+        The opened file, which must be closed or flushed before the image is optimized or unmounted.
     """
-    proc = subprocess.Popen(
-        [
-            "DISM",
-            "/unmount-wim",
-            f"/MountDir:{wim_mount_path}",
-            "/commit",
-        ],
-        stdout=subprocess.PIPE,
-        universal_newlines=True,
-    )
+    return open(path, mode, buffering=buffer_size)
 
-    stdout_thread = threading.Thread(target=show_progress, args=(proc.stdout,))
-    stdout_thread.start()
 
-    proc.wait()
-    stdout_thread.join()
-
-    shutil.rmtree(wim_mount_path, onerror=onerror)
-
-
-def delete_other_editions(wim_file: str, edition_to_keep: dict) -> None:
+def unmount_wim(wim_mount_path: str) -> None:
     """
-    Deletes other editions in a WIM file, except the selected edition.
+    Unmounts a previously mounted Windows Imaging Format (WIM) file and commits changes.
 
     Args:
-        wim_file (str): The path to the WIM file.
-        edition_to_keep (dict): A dictionary containing the details of the edition to keep.
+        wim_mount_path (str): The path to the mount point of the WIM file.
 
     Returns:
         None
-    """
-    edition_to_keep["Index"] = "1"
 
-    while len(new_info := list_wim_indexes(wim_file)) != 1:
-        index_to_remove = next(info["Index"] for info in new_info if info != edition_to_keep)  # type: ignore
-        print(
-            f"Removing {next(info['Name'] for info in new_info if info != edition_to_keep)}"  # type: ignore
+    """
+    asyncio.run(
+        run_with_progress(
+            [
+                "DISM",
+                "/unmount-wim",
+                f"/MountDir:{wim_mount_path}",
+                "/commit",
+            ]
         )
-        delete_wim_index(wim_file, index_to_remove)
+    )
 
+    force_rmtree(wim_mount_path)
 
-def list_wim_indexes(wim_file: str) -> list[dict[str, str]]:
+
+def iter_wim_indexes(wim_file: str) -> Iterator[dict[str, str]]:
     """
-    Lists all indexes in a Windows Imaging Format (WIM) file.
+    Yields the indexes of a Windows Imaging Format (WIM) file as DISM lists them.
 
     Args:
         wim_file (str): The path to the WIM file.
 
-    Returns:
-        A list of dictionaries containing information about the WIM file indexes.
+    Yields:
+        A dictionary containing information about a WIM file index.
 
     """
-    result = subprocess.run(
-        [
-            "dism",
-            "/get-WimInfo",
-            f"/WimFile:{wim_file}",
-        ],
-        capture_output=True,
-        text=True,
-    )
     # Given this input:
     # ^
     # ^Deployment Image Servicing and Management tool
@@ -135,76 +130,153 @@ def list_wim_indexes(wim_file: str) -> list[dict[str, str]]:
     # ^
     # ^The operation completed successfully.
     #
-    # The process consists of the following steps:
-    # 1. Convert the input into a list of strings containing ["Index : 1\nName : ...", "Index : 2\nName : ..."]
-    # 2. For each entry in the list, split the string by `\n` to obtain a new list: ["Index : 1", "Name : ..."]
-    # 3. For every element in the sublist, split it by `:` to create a list like this: [["Index ", " 1"], ["Name ", " ..."]].
-    # 4. Strip each element of the sublist of additional spaces using str.strip, and convert them into tuples: [("Index", "1"), ("Name", "...")]
-    # 5. Turn the tuples into a dictionary: {'Index': '1', 'Name': '...'}
-    # 6. Append the dictionary to a list and process the next entry until all entries are processed: [{'Index': '1', 'Name': '...'}, {'Index': '2', 'Name': '...'}]
-    indexes = result.stdout.split("\n\n")[2:-1]
-    return [
-        dict(tuple(map(str.strip, kv.split(":"))) for kv in index.split("\n"))
-        for index in indexes
-    ]
-
-
-def optimize_wim_file(wim_file: str) -> None:
-    old_wim = os.path.join(
-        os.path.dirname(wim_file), f"{os.path.basename(wim_file)}.old"
-    )
-    os.rename(wim_file, old_wim)
-    # Exports the index to a new wim file,
-    # in which the [DELETED] folder will be gone and the size reduced.
-    # (After every dism command the deleted/changed files are saved in the wim inside [DELETED])
-    subprocess.run(
+    # Every "Key : Value" line from an "Index : n" line onwards is added to the current index,
+    # which is yielded as soon as the blank line ending its block is read: {'Index': '1', 'Name': '...'}
+    with subprocess.Popen(
         [
-            "DISM",
-            "/Export-Image",
-            f"/SourceImageFile:{old_wim}",
-            "/SourceIndex:1",
-            f"/DestinationImageFile:{wim_file}",
-            "/Compress:max",
-            "/Checkintegrity",
+            "dism",
+            "/get-WimInfo",
+            f"/WimFile:{wim_file}",
         ],
         stdout=subprocess.PIPE,
-    )
+        text=True,
+    ) as proc:
+        index: dict[str, str] = {}
+        for line in proc.stdout:  # type: ignore
+            match = _KV.match(line.strip())
+            if match and (index or match[1] == "Index"):
+                index[match[1]] = match[2]
+            elif index:
+                yield index
+                index = {}
 
-    os.remove(old_wim)
+        if index:
+            yield index
 
 
-def optimize_wim_image(wim_mount_path: str):
-    subprocess.run(
-        [
-            "DISM",
-            f"/Image:{wim_mount_path}",
-            "/Cleanup-Image",
-            "/StartComponentCleanup",
-            "/ResetBase",
-        ],
-        # stdout=subprocess.PIPE,
-    )
+def list_wim_indexes(wim_file: str) -> list[dict[str, str]]:
+    """
+    Lists all indexes in a Windows Imaging Format (WIM) file.
 
+    Args:
+        wim_file (str): The path to the WIM file.
 
-def delete_wim_index(wim_file, index):
+    Returns:
+        A list of dictionaries containing information about the WIM file indexes.
+
+    """
+    wim_file = os.path.abspath(wim_file)
+    stat = os.stat(wim_file)
+    indexes = _list_wim_indexes(wim_file, stat.st_mtime, stat.st_size)
+    # Copies, so that callers cannot alter the cached indexes
+    return [dict(index) for index in indexes]
+
+
+@functools.lru_cache(maxsize=WIM_INDEX_CACHE_SIZE)
+def _list_wim_indexes(
+    wim_file: str, mtime: float, size: int
+) -> tuple[dict[str, str], ...]:
+    # The modification time and size are part of the key, so a modified WIM file is listed again
+    # On disk, WIM files are identified by their contents, as extracted copies get a new path every run
+    key = _wim_identity(wim_file, size)
+    cache = _read_index_cache()
+    if key in cache:
+        indexes = cache.pop(key)
+    else:
+        indexes = list(iter_wim_indexes(wim_file))
+        if not indexes:
+            # DISM failed to read the WIM file, there is nothing worth persisting
+            return ()
+
+    # Re-inserted at the end, so that only the most recently listed WIM files are kept
+    cache[key] = indexes
+    _write_index_cache(dict(list(cache.items())[-WIM_INDEX_CACHE_SIZE:]))
+    return tuple(indexes)
+
+
+def _wim_identity(wim_file: str, size: int) -> str:
+    # The header of a WIM file holds its GUID and the location of its metadata,
+    # and the XML data describing its indexes is written at its end
+    digest = hashlib.sha256()
+    with open(wim_file, "rb") as f:
+        digest.update(f.read(WIM_HEADER_SIZE))
+        f.seek(max(size - WIM_TAIL_SIZE, 0))
+        digest.update(f.read(WIM_TAIL_SIZE))
+    return f"{size}:{digest.hexdigest()}"
+
+
+def _read_index_cache() -> dict[str, Any]:
+    try:
+        with open(WIM_INDEX_CACHE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_index_cache(cache: dict[str, Any]) -> None:
+    try:
+        os.makedirs(os.path.dirname(WIM_INDEX_CACHE), exist_ok=True)
+        with open(WIM_INDEX_CACHE, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+    except OSError:
+        # The cache is only an optimization
+        pass
+
+
+def optimize_wim_file(wim_file: str, index: str = "1") -> None:
     """
-    Deletes an index from a Windows Imaging Format (WIM) file.
+    Rewrites a Windows Imaging Format (WIM) file so it only contains the given index.
 
     Args:
         wim_file (str): The path to the WIM file.
-        index (str): The index to be deleted.
+        index (str, optional): The index of the image to keep. Defaults to "1".
 
     Returns:
         None
 
+    Raises:
+        subprocess.CalledProcessError: If the image could not be exported.
     """
-    subprocess.run(["attrib", "-r", wim_file])
+    new_wim = f"{wim_file}.tmp"
+    # Exports the index to a new wim file, which drops every other edition in one pass,
+    # and in which the [DELETED] folder will be gone and the size reduced.
+    # (After every dism command the deleted/changed files are saved in the wim inside [DELETED])
+    # DISM appends to an existing destination, so a file left by a failed run must go first
+    if os.path.exists(new_wim):
+        clear_readonly(new_wim)
+        os.remove(new_wim)
+    try:
+        subprocess.run(
+            [
+                "DISM",
+                "/Export-Image",
+                f"/SourceImageFile:{wim_file}",
+                f"/SourceIndex:{index}",
+                f"/DestinationImageFile:{new_wim}",
+                "/Compress:max",
+                "/Checkintegrity",
+            ],
+            stdout=subprocess.PIPE,
+            check=True,
+        )
+    except BaseException:
+        if os.path.exists(new_wim):
+            clear_readonly(new_wim)
+            os.remove(new_wim)
+        raise
+
+    clear_readonly(wim_file)
+    os.replace(new_wim, wim_file)
+
+
+def optimize_wim_image(wim_mount_path: str):
     subprocess.run(
         [
             "DISM",
-            "/Delete-Image",
-            f"/ImageFile:{wim_file}",
-            f"/Index:{index}",
+            f"/Image:{wim_mount_path}",
+            "/Cleanup-Image",
+            "/StartComponentCleanup",
+            "/ResetBase",
         ],
-        stdout=subprocess.PIPE,
+        # stdout=subprocess.PIPE,
     )
@@ -20,6 +20,7 @@ class TestInstaller(TestCaseBase):
         self.parameters = None
 
         os.makedirs(os.path.join(self.wim_mount_directory, r"Windows\System32\config"))
+        # Each test gets its own copy of the hive, as installing executables writes to it
         shutil.copyfile(
             os.path.join(os.getcwd(), r"wimpatcher\tests\ressources\SOFTWARE"),
             os.path.join(self.wim_mount_directory, r"Windows\System32\config\SOFTWARE"),
@@ -43,6 +44,16 @@ class TestInstaller(TestCaseBase):
         self.assertEqual(self.installer.installer_file, self.installer_file)
         self.assertEqual(self.installer.parameters, [])
 
+    def test_install_location_outside_wim_mount_directory(self):
+        with self.assertRaises(ValueError):
+            Installer(
+                program_name=self.program_name,
+                install_location=f"{self.wim_mount_directory}_other\\install_location",
+                installer_file=self.installer_file,
+                wim_mount_directory=self.wim_mount_directory,
+                parameters=self.parameters,
+            )
+
     def test_install_directory(self):
         os.mkdir(self.installer_file)
         self.installer.install()
@@ -56,6 +67,25 @@ class TestInstaller(TestCaseBase):
 
         self.assertIsFolder(self.install_location)
 
+    def test_install_file_tarball(self):
+        archive_content = os.path.join(self.tempdir, "archive_content")
+        os.mkdir(archive_content)
+        with open(os.path.join(archive_content, "program.exe"), "w") as f:
+            f.write("dummydata")
+        shutil.make_archive(self.installer_file, "gztar", archive_content)
+        os.rename(f"{self.installer_file}.tar.gz", self.installer_file)
+        self.installer.install()
+
+        self.assertIsFile(os.path.join(self.install_location, "program.exe"))
+        # Archives are extracted, not moved into the image to be run on first logon
+        self.assertFalse(
+            os.path.exists(
+                os.path.join(
+                    self.install_location, os.path.basename(self.installer_file)
+                )
+            )
+        )
+
     def test_install_executable(self):
         with open(self.installer_file, "w") as f:
             f.write("dummydata")
@@ -1,38 +1,80 @@
 import argparse
+import io
 import os
 import sys
 import tempfile
+from dataclasses import dataclass, field
+from typing import Any
 
-from modules.iso import create_iso_from_folder, extract_iso, mount_iso, unmount_iso
-from modules.usb import prepare_usb_drive
 from modules.utils import Operations, read_toml, run_as_admin
-from modules.wim import (
-    delete_other_editions,
-    list_wim_indexes,
-    mount_wim,
-    optimize_wim_file,
-    optimize_wim_image,
-    unmount_wim,
+
+# The iso, usb and wim modules are imported by the functions using them,
+# so that short invocations such as --list-editions only load what they need.
+
+# Configuration sections and [general] keys which require changes inside of the Windows image
+CUSTOMIZATION_SECTIONS = (
+    "supported-software",
+    "software",
+    "apps",
+    "features",
+    "settings",
 )
+CUSTOMIZATION_GENERAL_KEYS = ("drivers", "updates")
+
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Settings read from the configuration file."""
+
+    iso: str
+    edition: str
+    customizations: dict[str, Any] = field(default_factory=dict)
+
+    @classmethod
+    def from_toml(cls: type["Config"], data: dict[str, Any]) -> "Config":
+        """Builds the configuration from the contents of a toml file.
+
+        Args:
+            data (dict[str, Any]): Contents of the configuration file.
+
+        Returns:
+            Config: The parsed configuration.
+        """
+        general = data["general"]
+        customizations = {
+            section: data[section]
+            for section in CUSTOMIZATION_SECTIONS
+            if section in data
+        }
+        customizations |= {
+            key: general[key] for key in CUSTOMIZATION_GENERAL_KEYS if key in general
+        }
+        return cls(general["iso"], general["Edition"], customizations)
 
 
-def create_custom_iso(iso_file: str, output_path: str):
+def create_custom_iso(output_path: str, cfg: Config):
+    from modules.iso import clone_iso_substituting, extract_file_from_iso
+
     with tempfile.TemporaryDirectory() as tmpdir:
-        extract_iso(iso_file, tmpdir)
+        # Only install.wim is modified, every other file is copied straight from the source iso when repacking
+        wim_file = os.path.join(tmpdir, "install.wim")
+        extract_file_from_iso(cfg.iso, "sources\\install.wim", wim_file)
 
-        patch_wim(f"{tmpdir}\\sources\\install.wim")
+        patch_wim(wim_file, cfg)
 
-        print("Repacking...")
-        create_iso_from_folder(tmpdir, output_path)
+        print("Repacking...", flush=True)
+        clone_iso_substituting(cfg.iso, output_path, {"/sources/install.wim": wim_file})
 
         print("Cleaning up...")
 
 
-def create_bootable_usb(iso_file: str, drive_letter: str):
+def create_bootable_usb(drive_letter: str, cfg: Config):
+    from modules.usb import prepare_usb_drive
+
     drive_path = f"{drive_letter}:"
-    prepare_usb_drive(iso_file, drive_path)
+    prepare_usb_drive(cfg.iso, drive_path)
 
-    patch_wim(f"{drive_path}\\sources\\install.wim")
+    patch_wim(f"{drive_path}\\sources\\install.wim", cfg)
 
 
 def display_wim_editions(wim_info: list[dict[str, str]]) -> dict[str, dict[str, str]]:
@@ -46,21 +88,50 @@ def display_wim_editions(wim_info: list[dict[str, str]]) -> dict[str, dict[str,
         A dictionary containing the valid indexes and their associated information.
     """
     valid_indexes = {}
+    lines = []
     for info in wim_info:
-        index = info["Index"]
         valid_indexes[info["Name"]] = info
-        print(f"{index} - {info['Name']} ({info['Size']})")
+        lines.append(f"{info['Index']} - {info['Name']} ({info['Size']})")
+    sys.stdout.write("".join(f"{line}\n" for line in lines))
     return valid_indexes
 
 
-def patch_wim(wim_file: str):
+def patch_wim(wim_file: str, cfg: Config):
+    from modules.wim import list_wim_indexes, optimize_wim_file
+
     wim_info = list_wim_indexes(wim_file)
 
+    index = "1"
     if len(wim_info) >= 1:
-        select_edition(wim_info, wim_file)
+        index = select_edition(wim_info, cfg)["Index"]
+
+    # Mounting and unmounting a WIM file takes minutes, only do it if there is something to change
+    if has_customizations(cfg):
+        customize_wim(wim_file, index)
+
+    # Exporting only the selected edition also removes the other editions from the WIM file
+    print("Optimizing WIM file...", flush=True)
+    optimize_wim_file(wim_file, index)
+
+
+def has_customizations(cfg: Config) -> bool:
+    """
+    Checks whether the configuration asks for changes inside of the Windows image.
+
+    Args:
+        cfg (Config): The parsed configuration file.
+
+    Returns:
+        True if the WIM file has to be mounted to apply the configuration.
+    """
+    return any(cfg.customizations.values())
+
+
+def customize_wim(wim_file: str, index: str):
+    from modules.wim import mount_wim, optimize_wim_image, unmount_wim
 
     print("Mounting WIM file...")
-    wim_mount_path = mount_wim(wim_file)
+    wim_mount_path = mount_wim(wim_file, index)
     try:
         print("Uninstalling unwanted apps...")
         ...
@@ -83,19 +154,15 @@ def patch_wim(wim_file: str):
         print("Applying settings...")
         ...
 
-        print("Optimizing WIM image...")
+        print("Optimizing WIM image...", flush=True)
         optimize_wim_image(wim_mount_path)
     finally:
         print("Unmounting WIM file...")
         unmount_wim(wim_mount_path)
 
-    print("Optimizing WIM file...")
-    optimize_wim_file(wim_file)
-
 
-def select_edition(wim_info: list[dict[str, str]], wim_file: str):
-    global CONFIG
-    selected_edition = CONFIG["general"]["Edition"]
+def select_edition(wim_info: list[dict[str, str]], cfg: Config) -> dict[str, str]:
+    selected_edition = cfg.edition
     print("Available editions:")
     valid_indexes = display_wim_editions(wim_info)
 
@@ -105,88 +172,106 @@ def select_edition(wim_info: list[dict[str, str]], wim_file: str):
     else:
         raise ValueError(f"'{selected_edition}' is not a valid selection!")
 
-    delete_other_editions(wim_file, selection)
+    return selection
 
 
 def main():
     run_as_admin()
-    parser = argparse.ArgumentParser(
-        description="WimPatcher - A tool for creating custom Windows ISO images with pre-installed programs"
-    )
-
-    parser.add_argument(
-        "-c",
-        "--config",
-        type=str,
-        help="Path to configuration file. Default: config.toml",
-        default="config.toml",
-    )
-    parser.add_argument(
-        "-o",
-        "--output",
-        type=str,
-        help="Path to the output ISO file. Required if '--usb' flag is not provided.",
-    )
-    parser.add_argument(
-        "-u",
-        "--usb",
-        type=str,
-        help="Path to the USB drive to flash the custom image onto. Warning: This will erase all data on the USB drive. Required if '--output' flag is not provided.",
-    )
-    parser.add_argument(
-        "-l",
-        "--list-editions",
-        type=str,
-        help="Displays Windows editions available from a provided WIM or ISO file.",
-    )
-
-    args = parser.parse_args()
-
-    if args.list_editions:
-        file_path = os.path.abspath(args.list_editions)
-        if os.path.isfile(file_path) and (
-            (file_ext := file_path[-4:].lower()) in [".iso", ".wim"]
-        ):
-            if file_ext == ".iso":
-                print(f'Mounting iso "{file_path}"...')
-                iso_mountpoint = mount_iso(file_path)
-                wim_file = f"{iso_mountpoint}\\sources\\install.wim"
+    # Output is written in 64 KB batches, and flushed explicitly before long operations
+    # Replaced streams, such as those of some IDE consoles, may not have a buffer to wrap
+    if hasattr(sys.stdout, "buffer"):
+        sys.stdout = io.TextIOWrapper(
+            io.BufferedWriter(sys.stdout.buffer.raw, buffer_size=65536),
+            encoding=sys.stdout.encoding,
+            errors=sys.stdout.errors,
+            write_through=False,
+            line_buffering=False,
+        )
+    # Buffered messages must still be shown when a step fails
+    try:
+        parser = argparse.ArgumentParser(
+            description="WimPatcher - A tool for creating custom Windows ISO images with pre-installed programs"
+        )
+
+        parser.add_argument(
+            "-c",
+            "--config",
+            type=str,
+            help="Path to configuration file. Default: config.toml",
+            default="config.toml",
+        )
+        parser.add_argument(
+            "-o",
+            "--output",
+            type=str,
+            help="Path to the output ISO file. Required if '--usb' flag is not provided.",
+        )
+        parser.add_argument(
+            "-u",
+            "--usb",
+            type=str,
+            help="Path to the USB drive to flash the custom image onto. Warning: This will erase all data on the USB drive. Required if '--output' flag is not provided.",
+        )
+        parser.add_argument(
+            "-l",
+            "--list-editions",
+            type=str,
+            help="Displays Windows editions available from a provided WIM or ISO file.",
+        )
+
+        args = parser.parse_args()
+
+        if args.list_editions:
+            file_path = os.path.abspath(args.list_editions)
+            file_ext = os.path.splitext(file_path)[1].lower()
+            is_iso = file_ext == ".iso"
+            if os.path.isfile(file_path) and file_ext in {".iso", ".wim"}:
+                from modules.wim import list_wim_indexes
+
+                if is_iso:
+                    from modules.iso import mount_iso, unmount_iso
+
+                    print(f'Mounting iso "{file_path}"...', flush=True)
+                    iso_mountpoint = mount_iso(file_path)
+                    wim_file = f"{iso_mountpoint}\\sources\\install.wim"
+                else:
+                    wim_file = file_path
+
+                try:
+                    wim_info = list_wim_indexes(wim_file)
+                    display_wim_editions(wim_info)
+                finally:
+                    if is_iso:
+                        print(f'Unmounting iso "{file_path}"...')
+                        iso_mountpoint = unmount_iso(file_path)
+                sys.exit()
             else:
-                wim_file = file_path
-
-            try:
-                wim_info = list_wim_indexes(wim_file)
-                display_wim_editions(wim_info)
-            finally:
-                if file_ext == ".iso":
-                    print(f'Unmounting iso "{file_path}"...')
-                    iso_mountpoint = unmount_iso(file_path)
-            sys.exit()
-        else:
-            parser.error("--list-editions takes an ISO or a WIM file as parameter")
-    elif not args.output and not args.usb:
-        parser.error("At least one of --output or --usb is required.")
-    elif args.output and args.usb:
-        parser.error("The --output and --usb arguments are mutually exclusive.")
+                parser.error("--list-editions takes an ISO or a WIM file as parameter")
+        elif not args.output and not args.usb:
+            parser.error("At least one of --output or --usb is required.")
+        elif args.output and args.usb:
+            parser.error("The --output and --usb arguments are mutually exclusive.")
 
-    global CONFIG
-    CONFIG = read_toml(args.config)
+        cfg = Config.from_toml(read_toml(args.config))
 
-    if args.output:
-        choice = Operations.CREATE_CUSTOM_ISO
-    else:
-        choice = Operations.CREATE_BOOTABLE_USB
-
-    match choice:
-        case Operations.CREATE_CUSTOM_ISO:
-            create_custom_iso(CONFIG["general"]["iso"], args.output)
-        case Operations.CREATE_BOOTABLE_USB:
-            create_bootable_usb(CONFIG["general"]["iso"], args.usb)
-
-    print(
-        f"Done! Your {'USB drive' if choice == Operations.CREATE_BOOTABLE_USB else 'custom ISO'} is ready!"
-    )
-    input("Press enter to continue...")
+        if args.output:
+            choice = Operations.CREATE_CUSTOM_ISO
+        else:
+            choice = Operations.CREATE_BOOTABLE_USB
+
+        match choice:
+            case Operations.CREATE_CUSTOM_ISO:
+                create_custom_iso(args.output, cfg)
+            case Operations.CREATE_BOOTABLE_USB:
+                create_bootable_usb(args.usb, cfg)
+
+        print(
+            f"Done! Your {'USB drive' if choice == Operations.CREATE_BOOTABLE_USB else 'custom ISO'} is ready!"
+        )
+        input("Press enter to continue...")
+    finally:
+        if sys.stdout is not None:
+            sys.stdout.flush()
 
 
 if __name__ == "__main__":